@@ -145,6 +145,12 @@ TEST_REQUIRED_PACKAGES = [
     'scipy == 1.1.0',
 ]
 
+# Optional dependencies, installed with e.g. `pip install tf-agents[numba]`.
+EXTRA_PACKAGES = {
+    # For CategoricalDqnAgent(use_numba_projection=True).
+    'numba': ['numba >= 0.45.0'],
+}
+
 REQUIRED_TFP_VERSION = '0.6.0'
 
 if '--release' in sys.argv:
@@ -197,7 +203,7 @@ setup(
     packages=find_packages(),
     install_requires=REQUIRED_PACKAGES,
     tests_require=TEST_REQUIRED_PACKAGES,
-    extras_require={'tests': TEST_REQUIRED_PACKAGES},
+    extras_require=dict(EXTRA_PACKAGES, tests=TEST_REQUIRED_PACKAGES),
     # Add in any packaged data.
     zip_safe=False,
     distclass=BinaryDistribution,
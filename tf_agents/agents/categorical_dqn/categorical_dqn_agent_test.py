@@ -19,6 +19,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
 import numpy as np
 import tensorflow as tf
 from tf_agents.agents.categorical_dqn import categorical_dqn_agent
@@ -32,6 +34,15 @@ from tf_agents.trajectories import time_step as ts
 from tf_agents.trajectories import trajectory
 from tf_agents.utils import common
 
+try:
+  import numba  # pylint: disable=g-import-not-at-top,unused-import
+except ImportError:
+  numba = None
+
+# The critic loss given by DummyCategoricalNet on the experience returned by
+# `CategoricalDqnAgentTest._stacked_transition_experience`.
+_EXPECTED_LOSS = 2.195
+
 
 class DummyCategoricalNet(network.Network):
 
@@ -84,6 +95,14 @@ class DummyCategoricalNet(network.Network):
     return logits, network_state
 
 
+class DummyFloat16CategoricalNet(DummyCategoricalNet):
+
+  def call(self, inputs, unused_step_type=None, network_state=()):
+    logits, network_state = super(DummyFloat16CategoricalNet, self).call(
+        inputs, unused_step_type, network_state)
+    return tf.cast(logits, tf.float16), network_state
+
+
 class DummyCategoricalQRnnNetwork(q_rnn_network.QRnnNetwork):
 
   def __init__(self,
@@ -135,6 +154,26 @@ class CategoricalDqnAgentTest(tf.test.TestCase):
     self._dummy_categorical_net = DummyCategoricalNet(self._obs_spec)
     self._optimizer = tf.train.GradientDescentOptimizer(0.01)
 
+  def _stacked_transition_experience(self):
+    """Returns the single transition experience used by the loss tests.
+
+    Due to the constant initialization of the DummyCategoricalNet, we can
+    expect a critic loss of `_EXPECTED_LOSS` on it every time.
+    """
+    observations = tf.constant([[1, 2], [3, 4]], dtype=tf.float32)
+    time_steps = ts.restart(observations, batch_size=2)
+
+    actions = tf.constant([0, 1], dtype=tf.int32)
+    action_steps = policy_step.PolicyStep(actions)
+
+    rewards = tf.constant([10, 20], dtype=tf.float32)
+    discounts = tf.constant([0.9, 0.9], dtype=tf.float32)
+    next_observations = tf.constant([[5, 6], [7, 8]], dtype=tf.float32)
+    next_time_steps = ts.transition(next_observations, rewards, discounts)
+
+    return test_utils.stacked_trajectory_from_transition(
+        time_steps, action_steps, next_time_steps)
+
   def testCreateAgentNestSizeChecks(self):
     action_spec = [
         tensor_spec.BoundedTensorSpec([1], tf.int32, 0, 1),
@@ -197,6 +236,163 @@ class CategoricalDqnAgentTest(tf.test.TestCase):
     evaluated_loss = self.evaluate(loss_info).loss
     self.assertAllClose(evaluated_loss, expected_loss, atol=1e-3)
 
+  def _summary_tags(self, summary_dir):
+    """Returns the tags of all the summaries written in `summary_dir`."""
+    tags = []
+    for file_name in os.listdir(summary_dir):
+      for event in tf.compat.v1.train.summary_iterator(
+          os.path.join(summary_dir, file_name)):
+        tags.extend(value.tag for value in event.summary.value)
+    return tags
+
+  def testCriticLossWithDebugSummaries(self):
+    summary_dir = self.get_temp_dir()
+    summary_writer = tf.compat.v2.summary.create_file_writer(summary_dir)
+    agent = categorical_dqn_agent.CategoricalDqnAgent(
+        self._time_step_spec,
+        self._action_spec,
+        self._dummy_categorical_net,
+        self._optimizer,
+        debug_summaries=True)
+
+    experience = self._stacked_transition_experience()
+
+    # The summary ops are not inputs of the loss, so the loss is computed in a
+    # function, whose automatic control dependencies also run them.
+    with summary_writer.as_default(), tf.compat.v2.summary.record_if(True):
+      loss_info = common.function(agent._loss)(experience)
+
+    self.evaluate(tf.compat.v1.global_variables_initializer())
+    self.evaluate(summary_writer.init())
+    evaluated_loss = self.evaluate(loss_info).loss
+    self.evaluate(summary_writer.flush())
+
+    # Debug summaries must not change the loss. They are written at step 0.
+    self.assertAllClose(evaluated_loss, _EXPECTED_LOSS, atol=1e-3)
+    tags = self._summary_tags(summary_dir)
+    self.assertEqual(
+        sum(tag.endswith('distribution_errors/mean') for tag in tags), 1)
+
+  def testDebugSummariesInterval(self):
+    if tf.executing_eagerly():
+      self.skipTest('The train op is built once and run in a session loop.')
+    summary_dir = self.get_temp_dir()
+    summary_writer = tf.compat.v2.summary.create_file_writer(summary_dir)
+    counter = common.create_variable('test_train_counter')
+
+    agent = categorical_dqn_agent.CategoricalDqnAgent(
+        self._time_step_spec,
+        self._action_spec,
+        self._dummy_categorical_net,
+        self._optimizer,
+        train_step_counter=counter,
+        debug_summaries=True,
+        debug_summaries_interval=2)
+
+    experience = self._stacked_transition_experience()
+
+    # `train` is wrapped in a function, so running it also runs the summary
+    # ops, and it increments the train step counter.
+    with summary_writer.as_default(), tf.compat.v2.summary.record_if(True):
+      train_step = agent.train(experience)
+
+    self.evaluate(tf.compat.v1.global_variables_initializer())
+    self.evaluate(summary_writer.init())
+    for step in range(4):
+      self.assertEqual(self.evaluate(counter), step)
+      self.evaluate(train_step)
+    self.evaluate(summary_writer.flush())
+
+    # The critic loss is written every step, the debug summaries only on steps
+    # 0 and 2.
+    tags = self._summary_tags(summary_dir)
+    self.assertEqual(
+        sum(tag.endswith('Losses/critic_loss') for tag in tags), 4)
+    self.assertEqual(
+        sum(tag.endswith('distribution_errors/mean') for tag in tags), 2)
+
+  def testDebugSummariesIntervalMustBePositive(self):
+    with self.assertRaisesRegexp(ValueError, '.*debug_summaries_interval.*'):
+      categorical_dqn_agent.CategoricalDqnAgent(
+          self._time_step_spec,
+          self._action_spec,
+          self._dummy_categorical_net,
+          self._optimizer,
+          debug_summaries=True,
+          debug_summaries_interval=0)
+
+  def testCriticLossWithFloat16Logits(self):
+    agent = categorical_dqn_agent.CategoricalDqnAgent(
+        self._time_step_spec,
+        self._action_spec,
+        DummyFloat16CategoricalNet(self._obs_spec),
+        self._optimizer)
+
+    experience = self._stacked_transition_experience()
+
+    # The loss is computed in float32, so it only differs from the float32
+    # network's loss by the rounding of the logits.
+    loss_info = agent._loss(experience)
+
+    self.evaluate(tf.global_variables_initializer())
+    evaluated_loss = self.evaluate(loss_info).loss
+    self.assertEqual(loss_info.loss.dtype, tf.float32)
+    self.assertAllClose(evaluated_loss, _EXPECTED_LOSS, atol=1e-2)
+
+  def testCriticLossWithMirroredStrategy(self):
+    if tf.executing_eagerly():
+      self.skipTest('The logical CPU devices are set up in the session config.')
+    strategy = tf.distribute.MirroredStrategy(['/cpu:0', '/cpu:1'])
+    with strategy.scope():
+      agent = categorical_dqn_agent.CategoricalDqnAgent(
+          self._time_step_spec,
+          self._action_spec,
+          DummyCategoricalNet(self._obs_spec),
+          self._optimizer)
+
+    experience = self._stacked_transition_experience()
+
+    def local_experience(replica_id):
+      return tf.nest.map_structure(
+          lambda x: tf.gather(x, [replica_id]), experience)
+
+    def replica_loss():
+      # Each replica only gets its own entry of the batch.
+      replica_id = tf.distribute.get_replica_context().replica_id_in_sync_group
+      return agent._loss(local_experience(replica_id)).loss
+
+    with strategy.scope():
+      per_replica_loss = strategy.extended.call_for_each_replica(replica_loss)
+      replica_losses = strategy.experimental_local_results(per_replica_loss)
+      expected_losses = [agent._loss(local_experience(replica_id)).loss
+                         for replica_id in range(2)]
+
+    # Each replica's loss only depends on its local batch.
+    config = tf.compat.v1.ConfigProto(device_count={'CPU': 2})
+    with self.session(config=config):
+      self.evaluate(tf.global_variables_initializer())
+      self.assertAllClose(self.evaluate(replica_losses),
+                          self.evaluate(expected_losses), atol=1e-3)
+
+  def testCriticLossWithNumbaProjection(self):
+    if numba is None:
+      self.skipTest('numba is not installed.')
+    agent = categorical_dqn_agent.CategoricalDqnAgent(
+        self._time_step_spec,
+        self._action_spec,
+        self._dummy_categorical_net,
+        self._optimizer,
+        use_numba_projection=True)
+
+    experience = self._stacked_transition_experience()
+
+    # The numba projection must give the same loss as the default one.
+    loss_info = agent._loss(experience)
+
+    self.evaluate(tf.global_variables_initializer())
+    evaluated_loss = self.evaluate(loss_info).loss
+    self.assertAllClose(evaluated_loss, _EXPECTED_LOSS, atol=1e-3)
+
   def testCriticLossNStep(self):
     agent = categorical_dqn_agent.CategoricalDqnAgent(
         self._time_step_spec,
@@ -403,6 +599,81 @@ class CategoricalDqnAgentTest(tf.test.TestCase):
     self.assertEqual(self.evaluate(counter), 0)
     self.evaluate(loss)
 
+  def testProjectDistribution(self):
+    supports = tf.constant([[0, 2, 4, 6, 8],
+                            [1, 3, 4, 5, 6]], dtype=tf.float32)
+    weights = tf.constant([[0.1, 0.6, 0.1, 0.1, 0.1],
+                           [0.1, 0.2, 0.5, 0.1, 0.1]], dtype=tf.float32)
+    target_support = tf.constant([4, 5, 6, 7, 8], dtype=tf.float32)
+
+    projection = categorical_dqn_agent.project_distribution(
+        supports, weights, target_support)
+
+    self.assertAllClose(self.evaluate(projection),
+                        [[0.8, 0.0, 0.1, 0.0, 0.1],
+                         [0.8, 0.1, 0.1, 0.0, 0.0]])
+
+  def testProjectDistributionBetweenAtoms(self):
+    supports = tf.constant([[4.5, 5.25, 9.0]], dtype=tf.float32)
+    weights = tf.constant([[0.2, 0.4, 0.4]], dtype=tf.float32)
+    target_support = tf.constant([4, 5, 6], dtype=tf.float32)
+
+    projection = categorical_dqn_agent.project_distribution(
+        supports, weights, target_support)
+
+    # 4.5 splits its weight evenly between 4 and 5, 5.25 gives 3/4 of its
+    # weight to 5 and 1/4 to 6, and 9.0 gets clipped to 6.
+    self.assertAllClose(self.evaluate(projection), [[0.1, 0.4, 0.5]])
+
+  def testProjectDistributionWithNonFiniteSupport(self):
+    supports = tf.constant([[0, 2, 4, 6, 8],
+                            [1, 3, np.nan, 5, 6]], dtype=tf.float32)
+    weights = tf.constant([[0.1, 0.6, 0.1, 0.1, 0.1],
+                           [0.1, 0.2, 0.5, 0.1, 0.1]], dtype=tf.float32)
+    target_support = tf.constant([4, 5, 6, 7, 8], dtype=tf.float32)
+
+    projection = self.evaluate(categorical_dqn_agent.project_distribution(
+        supports, weights, target_support))
+
+    # The NaN must not be dropped, nor leak into the other batch entries.
+    self.assertAllClose(projection[0], [0.8, 0.0, 0.1, 0.0, 0.1])
+    self.assertTrue(np.isnan(projection[1]).any())
+
+  def testProjectDistributionWithNumba(self):
+    if numba is None:
+      self.skipTest('numba is not installed.')
+    supports = tf.constant([[0, 2, 4, 6, 8],
+                            [4.5, 5.25, 9.0, 3.0, 7.5]], dtype=tf.float32)
+    weights = tf.constant([[0.1, 0.6, 0.1, 0.1, 0.1],
+                           [0.2, 0.4, 0.2, 0.1, 0.1]], dtype=tf.float32)
+    target_support = tf.constant([4, 5, 6, 7, 8], dtype=tf.float32)
+
+    expected_projection = categorical_dqn_agent.project_distribution(
+        supports, weights, target_support)
+    projection = categorical_dqn_agent.project_distribution_with_numba(
+        supports, weights, target_support)
+
+    self.assertEqual(projection.shape.as_list(), [2, 5])
+    self.assertAllClose(self.evaluate(projection),
+                        self.evaluate(expected_projection))
+
+  def testProjectDistributionWithNumbaAndNonFiniteSupport(self):
+    if numba is None:
+      self.skipTest('numba is not installed.')
+    supports = np.tile(np.linspace(-10, 10, 51, dtype=np.float32), (4, 1))
+    supports[1, 3] = np.nan
+    weights = np.full((4, 51), 1. / 51, dtype=np.float32)
+    target_support = tf.constant(np.linspace(-10, 10, 51), dtype=tf.float32)
+
+    projection = self.evaluate(
+        categorical_dqn_agent.project_distribution_with_numba(
+            tf.constant(supports), tf.constant(weights), target_support))
+
+    # The NaN must stay in its own batch entry, and never be written out of
+    # bounds into the others.
+    self.assertTrue(np.isnan(projection[1]).any())
+    self.assertAllClose(projection[[0, 2, 3]], weights[[0, 2, 3]], atol=1e-5)
+
 
 if __name__ == '__main__':
   tf.test.main()
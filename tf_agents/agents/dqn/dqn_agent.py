@@ -271,13 +271,15 @@ class DqnAgent(tf_agent.TFAgent):
 
   # Use @common.function in graph mode or for speeding up.
   def _train(self, experience, weights):
+    loss_kwargs = self._precompute_loss_kwargs(experience)
     with tf.GradientTape() as tape:
       loss_info = self._loss(
           experience,
           td_errors_loss_fn=self._td_errors_loss_fn,
           gamma=self._gamma,
           reward_scale_factor=self._reward_scale_factor,
-          weights=weights)
+          weights=weights,
+          **loss_kwargs)
     tf.debugging.check_numerics(loss_info[0], 'Loss is inf or nan')
     variables_to_train = self._q_network.trainable_weights
     assert list(variables_to_train), "No variables in the agent's q_network."
@@ -301,6 +303,23 @@ class DqnAgent(tf_agent.TFAgent):
 
     return loss_info
 
+  def _precompute_loss_kwargs(self, experience):
+    """Computes additional keyword arguments of `_loss` for `experience`.
+
+    This is called by `_train` before opening the gradient tape, so subclasses
+    can override it to compute the inputs of their loss that need no gradients
+    (e.g. from the target network) without the tape recording them.
+
+    Args:
+      experience: A batch of experience data in the form of a `Trajectory`, as
+        passed to `_train`.
+
+    Returns:
+      A dict of keyword arguments to pass to `_loss`.
+    """
+    del experience  # unused
+    return {}
+
   def _loss(self,
             experience,
             td_errors_loss_fn=element_wise_huber_loss,